@@ -1,58 +1,219 @@
 import logging
+import os
 import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from heapq import nlargest
 from urllib.parse import urlparse, urljoin
 from lxml import html, etree
 
 logger = logging.getLogger(__name__)
 
+VALID_SCHEMES = frozenset(["http", "https"])
+BAD_EXTENSIONS = frozenset([
+    "css", "js", "bmp", "gif", "jpg", "jpeg", "ico",
+    "png", "tif", "tiff", "mid", "mp2", "mp3", "mp4",
+    "wav", "avi", "mov", "mpeg", "ram", "m4v", "mkv", "ogg", "ogv", "pdf",
+    "ps", "eps", "tex", "ppt", "pptx", "doc", "docx", "xls", "xlsx", "names", "data", "dat", "exe", "bz2", "tar",
+    "msi", "bin", "7z", "psd", "dmg", "iso", "epub", "dll", "cnf", "tgz", "sha1",
+    "thmx", "mso", "arff", "rtf", "jar", "csv",
+    "rm", "smil", "wmv", "swf", "wma", "zip", "rar", "gz"])
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+# pages larger than this are truncated before parsing
+MAX_CONTENT_SIZE = 4 * 1024 * 1024
+UNSAFE_LINK_CHARS = frozenset(";[]\t\r\n")
+
+# the same url is parsed by extract_next_links, is_valid and the trap checks
+cached_urlparse = lru_cache(maxsize=65536)(urlparse)
+
+class LinkTextTarget:
+    """
+    Parser target that collects the href of every anchor and the text of the page while lxml parses it, so no element
+    tree has to be built for the page
+    """
+
+    def __init__(self):
+        self.hrefs = []
+        self.text = []
+
+    def start(self, tag, attrs):
+        if tag == 'a' and 'href' in attrs:
+            self.hrefs.append(attrs['href'])
+
+    def data(self, data):
+        self.text.append(data)
+
+    def close(self):
+        # reset the collected state so the target can be reused for the next page
+        hrefs, text = self.hrefs, ''.join(self.text)
+        self.hrefs = []
+        self.text = []
+        return hrefs, text
+
+
+# comments and processing instructions carry no links or text, so they are dropped while parsing. The parser is built
+# once and reused for every page parsed in this process
+PAGE_PARSER = html.HTMLParser(target=LinkTextTarget(), remove_comments=True, remove_pis=True, collect_ids=False,
+                              huge_tree=False)
+
+
+def tokenize(content):
+    return TOKEN_RE.findall(content.lower())
+
+
+def join_link(base_url, base_scheme, link):
+    """
+    Returns the absolute form of link. Absolute and scheme-relative http(s) links are built without going through
+    urljoin, which would parse base_url again for every link on the page. Anything else, or anything urlparse would
+    rewrite or reject (non-ascii characters, params, brackets, tabs, newlines, empty queries or fragments), falls back
+    to urljoin so invalid links still raise ValueError here
+    """
+    if link.isascii() and not UNSAFE_LINK_CHARS.intersection(link) and not link.endswith(('?', '#')) \
+            and '?#' not in link:
+        netloc_start = link.find('//') + 2
+        # only links with a non-empty host, urljoin takes the host of base_url otherwise
+        if netloc_start < len(link) and link[netloc_start] not in '/?#':
+            if link.startswith(('http://', 'https://')):
+                return link
+            if netloc_start == 2 and base_scheme:
+                return base_scheme + ':' + link
+    return urljoin(base_url, link)
+
+
+def parse_page(url_data):
+    """
+    Parses the content of a fetched url and returns a tuple of the absolute out links of the page, the counts of the
+    words on the page and the number of words on the page. Returns None if the content is empty or can't be parsed.
+    This function does not touch any crawler state, so it can run in a worker process
+    """
+    url = url_data['url']
+    final_url = url_data['final_url']
+    content = url_data['content']
+
+    if not content or not content.strip():
+        # print("Empty content: ", url)
+        return None
+
+    # lxml rejects str content that carries an encoding declaration, so str pages are parsed as utf-8 bytes
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8', errors='replace')
+
+    if len(content) > MAX_CONTENT_SIZE:
+        content = content[:MAX_CONTENT_SIZE]
+
+    try:
+        links, text = etree.fromstring(content, PAGE_PARSER)
+    except UnicodeDecodeError:
+        # print("Invalid content format: ", url)
+        return None
+    except etree.LxmlError:
+        # print("Unparsable content: ", url)
+        return None
+
+    output_links = []
+
+    base_url = final_url if final_url else url
+    try:
+        base_scheme = cached_urlparse(base_url).scheme
+    except ValueError:
+        base_scheme = None
+    # pages repeat the same hrefs in navigation and footers, join each distinct href once (keeping page order)
+    for link in dict.fromkeys(links):
+        try:
+            output_links.append(join_link(base_url, base_scheme, link))
+        except ValueError:     # Link does not appear to be an IPv4 or IPv6 address
+            print("Invalid output link: ", link)
+
+    words = tokenize(text)
+    return output_links, Counter(words), len(words)
+
+
+def fetch_and_parse(corpus, url):
+    return parse_page(corpus.fetch_url(url))
+
+
 class Crawler:
     """
     This class is responsible for scraping urls from the next available link in frontier and adding the scraped links to
     the frontier
     """
 
-    def __init__(self, frontier, corpus):
+    def __init__(self, frontier, corpus, workers=None):
         self.frontier = frontier
         self.corpus = corpus
-        self.subdomains = {}
-        self.max_out_links = (None, -1)
-        self.longest_page = (None, -1)
-        self.freq_words = {}
-        self.traps = []
-        self.downloaded = []
+        # number of processes fetching and parsing pages, defaults to the number of cpus
+        self.workers = workers
+        # analytics gathered while crawling, kept together so each page updates a single structure
+        self.stats = {
+            'subdomains': Counter(),
+            'max_out_links': (None, -1),
+            'longest_page': (None, -1),
+            'freq_words': Counter(),
+            'traps': [],
+            'downloaded': set()
+        }
         with open('stopwords.txt') as f:
-            self.stopwords = set(f.read().split('\n'))
+            self.stopwords = frozenset(f.read().split())
 
 
     def start_crawling(self):
         """
         This method starts the crawling process which is scraping urls from the next available link in frontier and adding
-        the scraped links to the frontier
+        the scraped links to the frontier. Pages are fetched and parsed in a pool of worker processes, while the frontier
+        and the analytics are only updated here, in the order the urls are queued. The urls at the head of the queue are
+        submitted ahead of time, up to a window of a few urls per worker, so the workers keep parsing while results are
+        folded in here. A url is only taken off the frontier when its result is collected, so a saved frontier keeps the
+        in-flight urls that were not reached yet. A url whose fetch or parse raised is logged and skipped
         """
         # i = 0
-        while self.frontier.has_next_url():
-            url = self.frontier.get_next_url()
-            logger.info("Fetching URL %s ... Fetched: %s, Queue size: %s", url, self.frontier.fetched, len(self.frontier))
-            url_data = self.corpus.fetch_url(url)
-
-            for next_link in self.extract_next_links(url_data):
-                if self.is_valid(next_link):
-                    if self.corpus.get_file_name(next_link) is not None:
-                        self.frontier.add_url(next_link)
-                    # i +=1
-            
+        workers = self.workers or os.cpu_count() or 1
+        window = workers * 4
+        # (url, future) pairs for the urls at the head of the frontier queue, in queue order
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while self.frontier.has_next_url():
+                # new urls are only appended to the queue, so the pending urls are always its first len(pending) urls
+                if len(pending) < window:
+                    for url in self.frontier.peek_next_urls(window)[len(pending):]:
+                        pending.append((url, executor.submit(fetch_and_parse, self.corpus, url)))
+
+                url, future = pending.popleft()
+                next_url = self.frontier.get_next_url()
+                if next_url != url:
+                    raise RuntimeError("Frontier head %s does not match processed URL %s" % (next_url, url))
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Processing URL %s ... Fetched: %s, Queue size: %s", url, self.frontier.fetched,
+                                len(self.frontier))
+                try:
+                    page = future.result()
+                except Exception:
+                    logger.exception("Failed to fetch or parse URL %s", url)
+                    continue
+                if page is None:
+                    continue
+                output_links, word_counts, words_length = page
+                self._record_page(url, output_links, word_counts, words_length)
+
+                for next_link in output_links:
+                    if self.is_valid(next_link):
+                        if self.corpus.get_file_name(next_link) is not None:
+                            self.frontier.add_url(next_link)
+                        # i +=1
+
             # if i > 10000:
                 # break
 
+        stats = self.stats
         with open('analytics.txt', 'w', encoding='utf-8') as analytics_file:
-            analytics_file.write("subdomains accessed: " + str(self.subdomains) + '\n\n')
-            analytics_file.write("page with most out links: " + str(self.max_out_links) + '\n\n')
-            analytics_file.write("longest page: " + str(self.longest_page) + '\n\n')
-            analytics_file.write("50 most common non-stopword words: " + str(sorted(self.freq_words.items(), key=lambda x: (x[1], x[0]), reverse=True)[:50]) + '\n\n')
-            analytics_file.write("trap urls: " + str(self.traps) + '\n\n')
-            analytics_file.write("downloaded urls: " + str(self.downloaded) + '\n\n')
-            # print(len(self.traps))
-            # print(len(self.downloaded))
+            analytics_file.write("subdomains accessed: " + str(dict(stats['subdomains'])) + '\n\n')
+            analytics_file.write("page with most out links: " + str(stats['max_out_links']) + '\n\n')
+            analytics_file.write("longest page: " + str(stats['longest_page']) + '\n\n')
+            analytics_file.write("50 most common non-stopword words: " + str(nlargest(50, stats['freq_words'].items(), key=lambda x: (x[1], x[0]))) + '\n\n')
+            analytics_file.write("trap urls: " + str(stats['traps']) + '\n\n')
+            analytics_file.write("downloaded urls: " + str(stats['downloaded']) + '\n\n')
+            # print(len(stats['traps']))
+            # print(len(stats['downloaded']))
     
 
     def extract_next_links(self, url_data):
@@ -65,105 +226,40 @@ class Crawler:
 
         Suggested library: lxml
         """
-        url = url_data['url']
-        final_url = url_data['final_url']
-        content = url_data['content']
-        encoded_content = self._encode_content(content)
-
-        tree = None
-        try:
-            tree = html.fromstring(encoded_content)
-        except UnicodeDecodeError:
-            # print("Invalid content format: ", url)
-            return []
-        except etree.ParserError:
-            # print("Empty content: ", url)
+        page = parse_page(url_data)
+        if page is None:
             return []
-        
-        output_links = []
-        
-        links = tree.xpath('//a/@href')
-        base_url = final_url if final_url else url
-        for link in links:
-            try:
-                output_links.append(urljoin(base_url, link))
-            except ValueError:     # Link does not appear to be an IPv4 or IPv6 address
-                print("Invalid output link: ", link)
 
+        output_links, word_counts, words_length = page
+        self._record_page(url_data['url'], output_links, word_counts, words_length)
+        return output_links
+
+
+    def _record_page(self, url, output_links, word_counts, words_length):
         # update subdomains visited and num urls processed from subdomain
-        domain = urlparse(url).netloc
-        if domain not in self.subdomains:
-            self.subdomains[domain] = 1
-        else:
-            self.subdomains[domain] += 1
+        domain = cached_urlparse(url).netloc
+        stats = self.stats
+        stats['subdomains'][domain] += 1
 
         # keep track of page with most valid outlinks
-        if len(output_links) > self.max_out_links[1]:
-            self.max_out_links = (url, len(output_links))
+        if len(output_links) > stats['max_out_links'][1]:
+            stats['max_out_links'] = (url, len(output_links))
 
         # add downloaded urls
-        self.downloaded.extend(output_links)
+        stats['downloaded'].update(output_links)
 
         # keep track of longest page in terms of word count
-        words = self._tokenize(tree.text_content())
-        words_length = len(words)
-        if words_length > self.longest_page[1]:
-            self.longest_page = (url, words_length)
+        if words_length > stats['longest_page'][1]:
+            stats['longest_page'] = (url, words_length)
 
         # keep track of freqwords
-        self._compute_word_frequencies(words)
-            
-        return output_links
-    
-
-    def _tokenize(self, content):
-        retlist = []
-        fast = slow = 0
-        while fast < len(content):
-            if not content[slow].isascii() or not content[slow].isalnum():
-                slow += 1
-                fast += 1
-            elif not content[fast].isascii() or not content[fast].isalnum():
-                retlist.append(''.join(content[slow:fast]).lower())
-                slow = fast
-            else:
-                fast += 1
-        
-        return retlist
-
+        self._compute_word_frequencies(word_counts)
 
-    def _compute_word_frequencies(self, tokens):
-        for token in tokens:
-            if token not in self.stopwords:
-                if token in self.freq_words:
-                    self.freq_words[token] += 1
-                else:
-                    self.freq_words[token] = 1
 
-
-    def _encode_content(self, content):
-        if isinstance(content, bytes):
-            return content
-        return content.encode('utf-8', errors='replace')
-    
-
-    # def _get_decoded_content(self, content):
-    #     if not content:
-    #         return None
-    #     if isinstance(content, str):
-    #         return content
-        
-    #     encoding = self._detect_encoding(content)
-    #     # if not encoding:
-    #     #     return None
-        
-    #     decoded_content = content.decode(encoding)
-    #     return decoded_content
-    
-
-    # def _detect_encoding(self, content):
-    #     res = chardet.detect(content)
-    #     return res['encoding']
+    def _compute_word_frequencies(self, counts):
+        for stopword in self.stopwords & counts.keys():
+            del counts[stopword]
+        self.stats['freq_words'].update(counts)
 
 
     def is_valid(self, url):
@@ -172,51 +268,54 @@ class Crawler:
         filter out crawler traps. Duplicated urls will be taken care of by frontier. You don't need to check for duplication
         in this method
         """
-        parsed = urlparse(url)
-        if parsed.scheme not in set(["http", "https"]):
-            return False
         try:
-            return ".ics.uci.edu" in parsed.hostname \
-                   and not re.match(".*\.(css|js|bmp|gif|jpe?g|ico" + "|png|tiff?|mid|mp2|mp3|mp4" \
-                                    + "|wav|avi|mov|mpeg|ram|m4v|mkv|ogg|ogv|pdf" \
-                                    + "|ps|eps|tex|ppt|pptx|doc|docx|xls|xlsx|names|data|dat|exe|bz2|tar|msi|bin|7z|psd|dmg|iso|epub|dll|cnf|tgz|sha1" \
-                                    + "|thmx|mso|arff|rtf|jar|csv" \
-                                    + "|rm|smil|wmv|swf|wma|zip|rar|gz|pdf)$", parsed.path.lower()) \
-                   and not self.is_trap(url, parsed)
-
-        except TypeError:
-            # print("TypeError for ", parsed)
+            parsed = cached_urlparse(url)
+        except ValueError:
+            # print("Invalid url: ", url)
             return False
+        # cheapest checks first, the trap checks last
+        if parsed.scheme not in VALID_SCHEMES:
+            return False
+        hostname = parsed.hostname
+        if not hostname or not hostname.endswith(".ics.uci.edu"):
+            return False
+        path = parsed.path.lower()
+        return not self.has_bad_extension(path) and not self.is_trap(url, parsed)
         
 
+    def has_bad_extension(self, path):
+        dot = path.rfind('.')
+        return dot != -1 and path[dot + 1:] in BAD_EXTENSIONS
+
+
     def is_trap(self, url, parsed):
-        if self.is_repeat(parsed) or self.depth_long(parsed) or self.length_long(parsed) or self.contains_fragment(parsed):
-            self.traps.append(url)
+        parts = parsed.path.split('/')[1:]
+        if self.is_repeat(parsed, parts) or self.depth_long(parts) or self.length_long(parsed) or self.contains_fragment(parsed):
+            self.stats['traps'].append(url)
             return True
         return False
     
     
-    def is_repeat(self, parsed):
+    def is_repeat(self, parsed, parts):
         scheme = parsed.scheme
         netloc = parsed.netloc
-        path = parsed.path
-        parts = path.split('/')[1:]
-        if len(parts) >= 3 and parts[-2] in parts[:-2]:
-            index = parts[:-2].index(parts[-2])
-            concat_url = scheme + "://" + netloc + "/" + '/'.join(parts[:index]) + '/'.join(parts[-2:])
-            if concat_url in self.frontier.urls_set:
-                return True
-        return False
+        if len(parts) < 3:
+            return False
+        try:
+            # first earlier occurrence of the second-to-last segment, found in one scan without slicing
+            index = parts.index(parts[-2], 0, len(parts) - 2)
+        except ValueError:
+            return False
+        concat_url = scheme + "://" + netloc + "/" + '/'.join(parts[:index]) + '/'.join(parts[-2:])
+        return concat_url in self.frontier.urls_set
     
 
-    def depth_long(self, parsed):
-        path = parsed.path
-        parts = path.split('/')[1:]
+    def depth_long(self, parts):
         return (len(parts) > 5)
     
 
     def length_long(self, parsed):
-        length = len(parsed.path + parsed.params + parsed.query + parsed.fragment)
+        length = len(parsed.path) + len(parsed.params) + len(parsed.query) + len(parsed.fragment)
         return (length > 60)
     
 
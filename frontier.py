@@ -1,6 +1,7 @@
 import logging
 import os
 from collections import deque
+from itertools import islice
 import pickle
 
 logger = logging.getLogger(__name__)
@@ -49,6 +50,13 @@ class Frontier:
             self.fetched += 1
             return self.urls_queue.popleft()
 
+    def peek_next_urls(self, count):
+        """
+        Returns up to count urls from the front of the queue without removing them
+        :param count: the maximum number of urls to return
+        """
+        return list(islice(self.urls_queue, count))
+
     def has_next_url(self):
         """
         Returns true if there are more urls in the queue, otherwise false